@@ -1,7 +1,12 @@
 import copy
+import operator
 import warnings
+from collections import defaultdict
+from concurrent.futures import Executor
 from enum import Enum
-from typing import Union
+from itertools import repeat
+from types import MappingProxyType
+from typing import Optional, Union
 
 
 # =============================================================================
@@ -33,6 +38,83 @@ class BinaryCommutativeOperator(BinaryOperator):
     BITWISE_OR = '|'
     BITWISE_XOR = '^'
 
+# Operator members, iterated in the search loops
+_UNARY = tuple(UnaryOperator)
+_COMMUTATIVE = tuple(BinaryCommutativeOperator)
+_NONCOMMUTATIVE = tuple(BinaryNonCommutativeOperator)
+
+# How tightly each operator binds, following Python's precedence rules.
+# Strings only parenthesize operands which bind more loosely than needed.
+_PRECEDENCE = {
+    BinaryCommutativeOperator.BITWISE_OR: 1,
+    BinaryCommutativeOperator.BITWISE_XOR: 2,
+    BinaryCommutativeOperator.BITWISE_AND: 3,
+    BinaryNonCommutativeOperator.BIT_SHIFT_LEFT: 4,
+    BinaryNonCommutativeOperator.BIT_SHIFT_RIGHT: 4,
+    BinaryCommutativeOperator.ADD: 5,
+    BinaryNonCommutativeOperator.SUBTRACT: 5,
+    BinaryCommutativeOperator.MULTIPLY: 6,
+    BinaryNonCommutativeOperator.INT_DIVIDE: 6,
+    BinaryNonCommutativeOperator.MODULO: 6,
+    UnaryOperator.MINUS: 7,
+    UnaryOperator.BITWISE_NOT: 7,
+    BinaryNonCommutativeOperator.EXPONENTIATE: 8,
+}
+_UNARY_PRECEDENCE = 7
+_ATOM_PRECEDENCE = 9
+
+# Operators whose right operand must be positive
+_SHIFT_OPS = frozenset({
+    BinaryNonCommutativeOperator.BIT_SHIFT_LEFT,
+    BinaryNonCommutativeOperator.BIT_SHIFT_RIGHT,
+})
+
+# Largest magnitude of any value kept by the search.
+# Results beyond it make all later arithmetic slow.
+MAX_BITS = 4096
+MAX_ABS = 1 << MAX_BITS
+
+class _Reject(Exception):
+    """Raised by an operator whose result would certainly exceed MAX_ABS, before computing it."""
+
+def _int_pow(base: int, exponent: int) -> int:
+    if abs(base) > 1 and exponent > 0 and (abs(base).bit_length() - 1) * exponent > MAX_BITS:
+        # |base| ** exponent >= 2 ** ((bit_length - 1) * exponent) > MAX_ABS
+        raise _Reject
+    # Negative exponents produce floats, which are truncated like int(eval(...))
+    return int(base ** exponent)
+
+def _capped_lshift(value: int, shift: int) -> int:
+    if value and value.bit_length() + shift > MAX_BITS + 1:
+        # |value << shift| >= 2 ** (bit_length + shift - 1) > MAX_ABS
+        raise _Reject
+    return value << shift
+
+# Integer implementation of each operator, so expressions never need eval()
+_OPERATOR_FUNCTIONS = {
+    UnaryOperator.MINUS: operator.neg,
+    UnaryOperator.BITWISE_NOT: operator.invert,
+    BinaryNonCommutativeOperator.BIT_SHIFT_LEFT: _capped_lshift,
+    BinaryNonCommutativeOperator.BIT_SHIFT_RIGHT: operator.rshift,
+    BinaryNonCommutativeOperator.SUBTRACT: operator.sub,
+    BinaryNonCommutativeOperator.EXPONENTIATE: _int_pow,
+    BinaryNonCommutativeOperator.INT_DIVIDE: operator.floordiv,
+    BinaryNonCommutativeOperator.MODULO: operator.mod,
+    BinaryCommutativeOperator.ADD: operator.add,
+    BinaryCommutativeOperator.MULTIPLY: operator.mul,
+    BinaryCommutativeOperator.BITWISE_AND: operator.and_,
+    BinaryCommutativeOperator.BITWISE_OR: operator.or_,
+    BinaryCommutativeOperator.BITWISE_XOR: operator.xor,
+}
+
+# Each operator paired with its function, so the search loops call the function
+# directly instead of looking it up (and hashing the Enum member) for every pair
+_UNARY_FUNCTIONS = tuple((op, _OPERATOR_FUNCTIONS[op]) for op in _UNARY)
+_COMMUTATIVE_FUNCTIONS = tuple((op, _OPERATOR_FUNCTIONS[op]) for op in _COMMUTATIVE)
+_NONCOMMUTATIVE_FUNCTIONS = tuple((op, _OPERATOR_FUNCTIONS[op]) for op in _NONCOMMUTATIVE)
+_NONSHIFT_FUNCTIONS = tuple((op, function) for op, function in _NONCOMMUTATIVE_FUNCTIONS
+                            if op not in _SHIFT_OPS)
+
 
 # =============================================================================
 # EXPRESSIONS
@@ -41,18 +123,25 @@ class BinaryCommutativeOperator(BinaryOperator):
 class Expression:
     """A string expression that evaluates to an integer."""
 
-    def __init__(self, string: str, score: int) -> None:
+    __slots__ = ('_string', '_score', '_value')
+
+    def __init__(self, string: Optional[str], score: int, value: int) -> None:
         if type(self) is Expression:
             raise TypeError("Expression cannot be instantiated directly.")
-        self._string: str = string
+        self._string: Optional[str] = string
         self._score: int = score
+        self._value: int = value
 
     def evaluate(self) -> int:
         """Evaluate the expression and return an integer."""
-        return int(eval(self._string))
+        return self._value
+
+    def evaluate_string(self) -> int:
+        """Evaluate the expression's string with Python. Should always equal evaluate()."""
+        return int(eval(compile(self.string, '<expr>', 'eval')))
 
     def __str__(self):
-        return self._string
+        return self.string
 
     @property
     def string(self) -> str:
@@ -62,15 +151,33 @@ class Expression:
     def score(self) -> int:
         return self._score
 
+    @property
+    def precedence(self) -> int:
+        """How tightly the outermost operator of the expression binds."""
+        return _ATOM_PRECEDENCE
+
+    def _operand_string(self, min_precedence: int) -> str:
+        """String of the expression as an operand, parenthesized if it binds too loosely."""
+        if self.precedence < min_precedence:
+            return f"({self.string})"
+        return self.string
+
 class TrueExpression(Expression):
     """Base case expression. Evaluates to 1."""
 
+    __slots__ = ()
+
     def __init__(self) -> None:
-        super().__init__('True', 1)
+        super().__init__('True', 1, 1)
+
+    def evaluate(self) -> int:
+        return 1
 
 class CompositeExpression(Expression):
     """Composite expression, composed of at least one operator and one expression."""
 
+    __slots__ = ('_operator', '_expr_1', '_expr_2')
+
     def __init__(self,
                  operator: Union[UnaryOperator, BinaryOperator],
                  expr_1: Expression,
@@ -79,21 +186,90 @@ class CompositeExpression(Expression):
         if expr_2 is None:  # Unary operator case
             if not isinstance(operator, UnaryOperator):
                 raise TypeError("Operator is binary, but only one expression was given!")
-            string = f"{operator.value}({expr_1._string})"
             score = expr_1.score + 1
+            value = _OPERATOR_FUNCTIONS[operator](expr_1._value)
         else:  # Binary operator case
             if not isinstance(operator, BinaryOperator):
                 raise TypeError("Operator is unary, but two expressions were given!")
-            string = f"({expr_1._string}){operator.value}({expr_2._string})"
             score = expr_1.score + expr_2.score + 1
+            value = _OPERATOR_FUNCTIONS[operator](expr_1._value, expr_2._value)
 
-        super().__init__(string, score)
+        # The string is only built when requested, since most candidates are discarded
+        super().__init__(None, score, value)
+        self._operator = operator
+        self._expr_1: Expression = expr_1
+        self._expr_2: Optional[Expression] = expr_2
+
+    @property
+    def precedence(self) -> int:
+        return _PRECEDENCE[self._operator]
+
+    @property
+    def string(self) -> str:
+        if self._string is None:
+            precedence = self.precedence
+            if self._expr_2 is None:
+                operand = self._expr_1._operand_string(_UNARY_PRECEDENCE)
+                self._string = f"{self._operator.value}{operand}"
+            else:
+                if self._operator is BinaryNonCommutativeOperator.EXPONENTIATE:
+                    # Right-associative, and binds tighter than a unary operator on its left
+                    left = self._expr_1._operand_string(precedence + 1)
+                    right = self._expr_2._operand_string(_UNARY_PRECEDENCE)
+                else:
+                    # Left-associative
+                    left = self._expr_1._operand_string(precedence)
+                    right = self._expr_2._operand_string(precedence + 1)
+                self._string = f"{left}{self._operator.value}{right}"
+        return self._string
 
 
 # =============================================================================
 # OPTIMIZER
 # =============================================================================
 
+def _combine_values(values_1: list[int],
+                    values_2: list[int],
+                    seen: Union[set[int], frozenset[int]],
+                    found: set[int]) -> list[tuple[int, BinaryOperator, int, int]]:
+    """
+    Apply the binary operators to every pair of values from `values_1` and `values_2`.
+    Returns (value, operator, i, j) for each result which is in neither `seen` nor
+    `found`, where i and j index `values_1` and `values_2`. New results are added to
+    `found`, and `seen` is only read. Results with a magnitude above MAX_ABS are dropped.
+    """
+    max_abs = MAX_ABS
+    results = []
+    for i, value_1 in enumerate(values_1):
+        for j, value_2 in enumerate(values_2):
+            if value_1 <= value_2:
+                # Commutative operators (no need calculate both ways)
+                for op, function in _COMMUTATIVE_FUNCTIONS:
+                    try:
+                        value = function(value_1, value_2)
+                    except (_Reject, OverflowError):
+                        continue
+                    if (value not in found and value not in seen
+                            and -max_abs <= value <= max_abs):
+                        found.add(value)
+                        results.append((value, op, i, j))
+
+            # Non-commutative operators. Cannot bit-shift by negative value,
+            # and bit-shift by zero is pointless
+            functions = _NONCOMMUTATIVE_FUNCTIONS if value_2 > 0 else _NONSHIFT_FUNCTIONS
+            for op, function in functions:
+                try:
+                    value = function(value_1, value_2)
+                except (_Reject, OverflowError, ZeroDivisionError):
+                    # Result is too large to keep, or undefined
+                    continue
+                if (value not in found and value not in seen
+                        and -max_abs <= value <= max_abs):
+                    found.add(value)
+                    results.append((value, op, i, j))
+
+    return results
+
 class ExpressionOptimizer:
     def __init__(self):
         # ExpressionOptimizer contains an expression for all targets which can
@@ -103,31 +279,45 @@ class ExpressionOptimizer:
         # Map of score to list of expressions with that score
         # Each expression in the list must have a different target,
         # and a target will only be found once in the entire dictionary
-        self._min_s_exprs: dict[int, list[Expression]] = {
-            1: [TrueExpression()]
-        }
+        self._min_s_exprs: defaultdict[int, list[Expression]] = defaultdict(list)
+        self._min_s_exprs[1].append(TrueExpression())
+
+        # Map of score to the values of the expressions in `_min_s_exprs`,
+        # in the same order, so the search can read plain ints
+        self._vals_by_score: defaultdict[int, list[int]] = defaultdict(list)
+        self._vals_by_score[1].append(1)
 
         # Map of targets to min-s expression with that target
         self._targs: dict[int, Expression] = {
             1: TrueExpression()
         }
 
+        # Set of all targets in `_targs`, for fast membership tests
+        self._seen: set[int] = {1}
+
     def _get_score_exprs(self, score: int) -> list[Expression]:
         return self._min_s_exprs[score]
 
-    def _add_expr_if_better(self, expr: Expression) -> bool:
-        if expr.evaluate() in self._targs.keys():
-            # An equal or better expression was already found
-            return False
-
-        # New target reached!
-        self._targs[expr.evaluate()] = expr
-        self._min_s_exprs[expr.score] = self._min_s_exprs.get(expr.score, []) + [expr]
-
-        return True
+    def _add_expr(self, expr: Expression) -> None:
+        # Caller must ensure the target is new (it may already be in `_seen`)
+        value = expr.evaluate()
+        self._seen.add(value)
+        self._targs[value] = expr
+        self._min_s_exprs[expr.score].append(expr)
+        self._vals_by_score[expr.score].append(value)
 
     def get_min_s_exprs(self):
-        return copy.deepcopy(self._min_s_exprs)
+        """
+        Read-only view of the map of score to expressions, without copying the
+        expressions. Missing scores raise KeyError. The lists are the optimizer's
+        own, so they must not be modified. Use snapshot() for an independent copy.
+        """
+        # Plain dict, so a missing score does not insert into the defaultdict
+        return MappingProxyType(dict(self._min_s_exprs))
+
+    def snapshot(self):
+        """Independent copy of the map of score to expressions."""
+        return copy.deepcopy(dict(self._min_s_exprs))
 
     def get_targ_exprs(self):
         return copy.deepcopy(self._targs)
@@ -158,48 +348,58 @@ class ExpressionOptimizer:
     def max_score(self):
         return self._max_score
 
-    def increase_max_score(self) -> int:
+    def increase_max_score(self, executor: Optional[Executor] = None) -> int:
         """
         Increase the maximum allowed score of the expressions.
         Returns the number of new targets reached.
+        If an executor is given, the pairs of scores are combined in parallel.
+        The result is the same as when combining them one at a time.
+        The search is pure Python, so only a ProcessPoolExecutor can speed it up;
+        a ThreadPoolExecutor is limited by the GIL.
         """
-        # Search for composite expressions that will have a score of max_score + 1
-        new_exprs = []
+        # Search for composite expressions that will have a score of max_score + 1.
+        # They are added as soon as they are found, which is safe because the
+        # search only reads expressions with a score of max_score or lower.
 
         # Unary operators
         for expr in self._get_score_exprs(self._max_score):
-            for op in UnaryOperator:
-                new_exprs.append(CompositeExpression(op, expr))
-
-        # Binary non-commutative operators
-        for score_1 in range(1, self._max_score):
-            score_2 = self._max_score - score_1
-            # score_1 + score_2 + 1 = max_score + 1
-
-            # Iterate over all pairs of expressions which yield expressions
-            # with a score of max_score + 1 when combined via a binary operator
-            for expr_1 in self._get_score_exprs(score_1):
-                for expr_2 in self._get_score_exprs(score_2):
-
-                    if expr_1.evaluate() <= expr_2.evaluate():
-                        # Commutative operators (no need calculate both ways)
-                        for op in BinaryCommutativeOperator:
-                            new_exprs.append(CompositeExpression(op, expr_1, expr_2))
-
-                    # Non-commutative operators
-                    for op in BinaryNonCommutativeOperator:
-
-                        if ((op in [BinaryNonCommutativeOperator.BIT_SHIFT_LEFT,
-                            BinaryNonCommutativeOperator.BIT_SHIFT_RIGHT])
-                            and expr_2.evaluate()) <= 0:
-                            # Cannot bit-shift by negative value,
-                            # and bit-shift by zero is pointless
-                            continue
-
-                        new_exprs.append(CompositeExpression(op, expr_1, expr_2))
-
-        for new_expr in new_exprs:
-            self._add_expr_if_better(new_expr)
+            value = expr.evaluate()
+            for op, function in _UNARY_FUNCTIONS:
+                new_value = function(value)
+                if new_value in self._seen:
+                    # Target was already reached with a lower or equal score
+                    continue
+                if not -MAX_ABS <= new_value <= MAX_ABS:
+                    continue
+                self._add_expr(CompositeExpression(op, expr))
+
+        # Binary operators
+        # Pairs of scores which yield expressions with a score of max_score + 1
+        # when combined via a binary operator (score_1 + score_2 + 1 = max_score + 1)
+        score_pairs = [(score_1, self._max_score - score_1)
+                       for score_1 in range(1, self._max_score)]
+        values_1 = [self._vals_by_score[score_1] for score_1, _ in score_pairs]
+        values_2 = [self._vals_by_score[score_2] for _, score_2 in score_pairs]
+
+        if executor is None:
+            # New targets are claimed in `_seen` by _combine_values as they are found
+            results = map(_combine_values, values_1, values_2,
+                          repeat(frozenset()), repeat(self._seen))
+        else:
+            # Each task only drops targets it found itself, or which were reached
+            # before the search. The rest are dropped below, in the serial order.
+            results = executor.map(_combine_values, values_1, values_2,
+                                   repeat(frozenset(self._seen)),
+                                   [set() for _ in score_pairs])
+
+        for (score_1, score_2), records in zip(score_pairs, results):
+            exprs_1 = self._get_score_exprs(score_1)
+            exprs_2 = self._get_score_exprs(score_2)
+            for value, op, i, j in records:
+                if executor is not None and value in self._seen:
+                    # Target was found by an earlier pair of scores
+                    continue
+                self._add_expr(CompositeExpression(op, exprs_1[i], exprs_2[j]))
 
         self._max_score += 1
 
@@ -210,20 +410,29 @@ class ExpressionOptimizer:
 # ENTRY POINT
 # =============================================================================
 
+# Number of times to increase the max score. Each round takes roughly twice
+# as long as the previous one, so this cannot grow much further.
+MAX_ROUNDS = 18
+
+# Whether to check that every expression's string evaluates to its value
+CHECK_STRINGS = False
+
 if __name__ == "__main__":
     # Python doesn't like it when you do ~True, because it thinks you're doing it by mistake! I am not.
     warnings.filterwarnings("ignore", category=DeprecationWarning)
 
     optimizer = ExpressionOptimizer()
-    for i in range(100):
-        try:
-            optimizer.get_min_s_exprs()
-            optimizer.print_newest_exprs()
-            optimizer.increase_max_score()
-        except OverflowError:
-            break
+    for i in range(MAX_ROUNDS):
+        optimizer.print_newest_exprs()
+        optimizer.increase_max_score()
+
+    targ_exprs = optimizer.get_targ_exprs()
+    if CHECK_STRINGS:
+        for targ, expr in targ_exprs.items():
+            if expr.evaluate_string() != targ:
+                print(f"Mismatch! {expr.string} != {targ}")
 
-    for targ in sorted(list(optimizer.get_targ_exprs())):
+    for targ in sorted(list(targ_exprs)):
         try:
             print(targ)
         except ValueError: